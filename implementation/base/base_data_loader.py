@@ -1,7 +1,9 @@
 from typing import Tuple, Union, Optional
 
 import numpy as np
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.dataloader import default_collate
 from torch.utils.data.sampler import SubsetRandomSampler
 
@@ -33,6 +35,11 @@ class BaseDataLoader(DataLoader):
         if val_dataset is None:
             self.sampler, self.valid_sampler = self._split_sampler(self.validation_split)
             super().__init__(sampler=self.sampler, **self.init_kwargs)
+        elif dist.is_initialized():
+            # one shard of the training set per process, DistributedSampler takes over shuffling
+            self.sampler = DistributedSampler(train_dataset, shuffle=self.shuffle)
+            self.init_kwargs['shuffle'] = False
+            super().__init__(sampler=self.sampler, **self.init_kwargs)
         else:
             super().__init__(**self.init_kwargs)
 
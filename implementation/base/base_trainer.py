@@ -1,9 +1,113 @@
+import copy
+import io
+import logging
+import mmap
+import os
+import queue
+import threading
+import zipfile
 from abc import abstractmethod
+from contextlib import contextmanager, nullcontext
 
 import torch
+import torch.distributed as dist
 from logger import CometWriter
 from numpy import inf
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
+from utils import init_distributed, is_main_process
+
+
+_DIRECT_IO_CHUNK = 1 << 22
+_DIRECT_IO_ALIGN = 4096
+
+
+def _write_direct(path, payload):
+    """
+    Write bytes with O_DIRECT in aligned 4 MiB chunks, bypassing the page cache
+
+    :param path: destination file
+    :param payload: bytes-like object to write
+    """
+    size = len(payload)
+    # anonymous mmap is page aligned, as O_DIRECT requires for the source buffer
+    chunk = mmap.mmap(-1, _DIRECT_IO_CHUNK)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    try:
+        with memoryview(chunk) as chunk_view:
+            for offset in range(0, size, _DIRECT_IO_CHUNK):
+                n = min(_DIRECT_IO_CHUNK, size - offset)
+                chunk_view[:n] = payload[offset:offset + n]
+                # the tail is padded to the block size and cut off again by ftruncate below
+                padded = -(-n // _DIRECT_IO_ALIGN) * _DIRECT_IO_ALIGN
+                chunk_view[n:padded] = bytes(padded - n)
+                if os.pwrite(fd, chunk_view[:padded], offset) != padded:
+                    raise OSError('short write to {}'.format(path))
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+        chunk.close()
+
+
+def _write_file(path, payload):
+    """
+    Write serialized checkpoint bytes, through O_DIRECT where the platform and file system support it
+
+    :param path: destination file
+    :param payload: bytes-like object to write
+    """
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            _write_direct(path, payload)
+            return
+        except OSError:
+            # e.g. tmpfs rejects O_DIRECT, fall back to buffered writes
+            pass
+    with open(path, 'wb', buffering=1 << 22) as f:
+        f.write(payload)
+
+
+@contextmanager
+def _frozen_batchnorm_stats(module):
+    """
+    Keep the BatchNorm layers of a module from updating their running stats, train mode still uses batch statistics
+
+    :param module: module whose BatchNorm layers are frozen for the duration of the context
+    """
+    batchnorms = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    tracking = [m.track_running_stats for m in batchnorms]
+    for m in batchnorms:
+        m.track_running_stats = False
+    try:
+        yield
+    finally:
+        for m, track in zip(batchnorms, tracking):
+            m.track_running_stats = track
+
+
+class _CachedReplicaDataParallel(torch.nn.DataParallel):
+    """
+    DataParallel reusing its replicas between forward calls without autograd
+
+    Replicas are rebuilt whenever a parameter or buffer was updated in place or the train/eval mode changed. With
+    autograd enabled every call replicates as usual, since the replicas are part of the graph.
+    """
+    def __init__(self, module, device_ids=None, output_device=None, dim=0):
+        super().__init__(module, device_ids=device_ids, output_device=output_device, dim=dim)
+        self._replicas = None
+        self._replica_key = None
+
+    def replicate(self, module, device_ids):
+        if torch.is_grad_enabled():
+            return super().replicate(module, device_ids)
+        key = (tuple(device_ids),
+               tuple(m.training for m in module.modules()),
+               tuple(t._version for t in module.parameters()),
+               tuple(t._version for t in module.buffers()))
+        if self._replicas is None or key != self._replica_key:
+            self._replicas = super().replicate(module, device_ids)
+            self._replica_key = key
+        return self._replicas
 
 
 class BaseTrainer:
@@ -14,7 +118,7 @@ class BaseTrainer:
         self.config = config
         self.logger = config.get_logger('trainer', config['trainer']['verbosity'])
 
-        if config['comet']['api'] is not None:
+        if config['comet']['api'] is not None and is_main_process():
             self.writer = CometWriter(
                 self.logger,
                 project_name = config['comet']['project_name'],
@@ -26,32 +130,62 @@ class BaseTrainer:
             self.writer = None
 
 
+        self._log_code_thread = None
         if self.writer is not None:
             self.writer.log_hyperparams(config.config)
-            self.writer.log_code()
+            # uploading the source does not need to hold up the start of training
+            self._log_code_thread = threading.Thread(target=self.writer.log_code, daemon=True)
+            self._log_code_thread.start()
 
         # setup GPU device if available, move model into configured device
         self.device, device_ids = self._prepare_device(config['n_gpu'])
-        self.model = model.to(self.device)
-
-        if reparametrization_net is not None:
-            self.reparametrization_net = reparametrization_net.to(self.device)
-        else:
-            self.reparametrization_net = None
-
-        if len(device_ids) > 1:
+        # input shapes are fixed, let cuDNN autotune the convolution algorithms once
+        torch.backends.cudnn.benchmark = True
+        self._move_all(model, reparametrization_net, train_criterion)
+        self.model = model
+        self.reparametrization_net = reparametrization_net
+
+        if config['trainer'].get('activation_checkpoint', False):
+            self._apply_activation_checkpointing(model, config['trainer'].get('activation_checkpoint_layers', []))
+
+        if dist.is_initialized():
+            # one process per GPU (torchrun), gradients are all-reduced during backward; buffers (BatchNorm
+            # running stats) are broadcast from rank 0 so evaluation is the same on every rank
+            output_device = device_ids[0] if device_ids else None
+            self.model = DistributedDataParallel(model, device_ids=device_ids or None, output_device=output_device,
+                                                 gradient_as_bucket_view=True)
+            if reparametrization_net is not None:
+                self.reparametrization_net = DistributedDataParallel(reparametrization_net,
+                                                                     device_ids=device_ids or None,
+                                                                     output_device=output_device,
+                                                                     gradient_as_bucket_view=True)
+        elif len(device_ids) > 1:
             self.model = torch.nn.DataParallel(model, device_ids=device_ids)
             if reparametrization_net is not None:
-                self.reparametrization_net = torch.nn.DataParallel(reparametrization_net, device_ids=device_ids)
+                self.reparametrization_net = _CachedReplicaDataParallel(reparametrization_net, device_ids=device_ids)
+
 
 
 
+        self.train_criterion = train_criterion
 
-        self.train_criterion = train_criterion.to(self.device)
+        if config['trainer'].get('compile', False):
+            # the wrapped model is compiled in place, so Dynamo splits the graph at the DDP bucket boundaries while
+            # the wrapper type and state_dict keys stay the same
+            mode = config['trainer'].get('compile_mode', 'reduce-overhead')
+            self.model.compile(mode=mode, dynamic=False)
+            # the train criterion stays eager: ncodLoss keeps state across calls, branches on the batch index and
+            # epoch and issues collectives, which CUDA graphs and Dynamo guards handle poorly
 
         
         self.val_criterion = val_criterion
         self.metrics = metrics
+        # log keys of the metrics, built once instead of every epoch
+        self._metric_keys = {
+            'metrics': [mtr.__name__ for mtr in self.metrics],
+            'val_metrics': ['val_' + mtr.__name__ for mtr in self.metrics],
+            'test_metrics': ['test_' + mtr.__name__ for mtr in self.metrics]
+        }
 
         self.optimizer = optimizer
         self.optimizer_loss = optimizer_loss
@@ -74,8 +208,31 @@ class BaseTrainer:
 
         self.start_epoch = 1
 
+        # opt-in torch.profiler over a few batches, stepped per batch by the epoch loops of the trainer; traces are
+        # written to the log dir for tensorboard
+        if cfg_trainer.get('profile', False):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(str(config.log_dir / 'profiler')),
+                record_shapes=False, profile_memory=False, with_stack=False)
+        else:
+            self._profiler = None
+
         self.checkpoint_dir = config.save_dir
 
+        # checkpoints are staged into pinned CPU buffers and written to disk by a background thread
+        self._staging_buffers = {}
+        self._mv_pinned = None
+        self._copy_stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self._save_queue = queue.Queue()
+        self._save_error = None
+        self._save_thread = threading.Thread(target=self._checkpoint_worker, daemon=True)
+        self._save_thread.start()
+
         if config.resume is not None:
             self._resume_checkpoint(config.resume)
 
@@ -88,70 +245,144 @@ class BaseTrainer:
         """
         raise NotImplementedError
 
+    def no_sync_ctx(self, is_last_microbatch):
+        """
+        Context skipping the DDP gradient all-reduce for all but the last micro-batch of an accumulation step
+
+        Use it around the backward pass in _train_epoch: with self.no_sync_ctx(is_last): loss.backward()
+
+        :param is_last_microbatch: True for the micro-batch after which the optimizer steps
+        """
+        if is_last_microbatch or not isinstance(self.model, DistributedDataParallel):
+            return nullcontext()
+        return self.model.no_sync()
+
     def train(self):
         """
         Full training logic
         """
         not_improved_count = 0
 
-        for epoch in tqdm(range(self.start_epoch, self.epochs + 1), desc='Total progress: '):
-            if epoch <= self.config['trainer']['warmup']:
-                result = self._warmup_epoch(epoch)
-            else:
-                result= self._train_epoch(epoch)
-
-            
-
-            # save logged informations into log dict
-            log = {'epoch': epoch}
-            for key, value in result.items():
-                if key == 'metrics':
-                    log.update({mtr.__name__: value[i] for i, mtr in enumerate(self.metrics)})
-                elif key == 'val_metrics':
-                    log.update({'val_' + mtr.__name__: value[i] for i, mtr in enumerate(self.metrics)})
-                elif key == 'test_metrics':
-                    log.update({'test_' + mtr.__name__: value[i] for i, mtr in enumerate(self.metrics)})
-                else:
-                    log[key] = value
-
-            # print logged informations to the screen
-            for key, value in log.items():
-                self.logger.info('    {:15s}: {}'.format(str(key), value))
-
-            # evaluate model performance according to configured metric, save best checkpoint as model_best
-            best = False
-            if self.mnt_mode != 'off':
-                try:
-                    # check whether model performance improved or not, according to specified metric(mnt_metric)
-                    improved = (self.mnt_mode == 'min' and log[self.mnt_metric] <= self.mnt_best) or \
-                               (self.mnt_mode == 'max' and log[self.mnt_metric] >= self.mnt_best)
-                except KeyError:
-                    self.logger.warning("Warning: Metric '{}' is not found. "
-                                        "Model performance monitoring is disabled.".format(self.mnt_metric))
-                    self.mnt_mode = 'off'
-                    improved = False
-
-                if improved:
-                    self.mnt_best = log[self.mnt_metric]
-                    not_improved_count = 0
-                    best = True
+        if self._profiler is not None:
+            self._profiler.start()
+        try:
+            for epoch in tqdm(range(self.start_epoch, self.epochs + 1), desc='Total progress: ', mininterval=2.0,
+                              disable=not is_main_process()):
+                # reshuffle the per-rank shards of the training set every epoch
+                sampler = getattr(getattr(self, 'data_loader', None), 'sampler', None)
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
+
+                if epoch <= self.config['trainer']['warmup']:
+                    result = self._warmup_epoch(epoch)
                 else:
-                    not_improved_count += 1
+                    result= self._train_epoch(epoch)
+                if isinstance(self.model, torch.nn.DataParallel):
+                    torch.cuda.synchronize()
 
-                if not_improved_count > self.early_stop:
-                    self.logger.info("Validation performance didn\'t improve for {} epochs. "
-                                     "Training stops.".format(self.early_stop))
-                    break
+            
 
-            if epoch % self.save_period == 0:
-                self._save_checkpoint(epoch, save_best=best)
+                # save logged informations into log dict
+                log = {'epoch': epoch}
+                for key, value in result.items():
+                    metric_keys = self._metric_keys.get(key)
+                    if metric_keys is not None:
+                        log.update(zip(metric_keys, value))
+                    else:
+                        log[key] = value
+
+                # print logged informations to the screen
+                # the lines are only formatted when INFO records are actually emitted
+                if is_main_process() and self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info('%s', '\n'.join('    {:15s}: {}'.format(str(key), value) for key, value in log.items()))
+
+                # evaluate model performance according to configured metric, save best checkpoint as model_best
+                best = False
+                if self.mnt_mode != 'off':
+                    try:
+                        # check whether model performance improved or not, according to specified metric(mnt_metric)
+                        improved = (self.mnt_mode == 'min' and log[self.mnt_metric] <= self.mnt_best) or \
+                                   (self.mnt_mode == 'max' and log[self.mnt_metric] >= self.mnt_best)
+                    except KeyError:
+                        self.logger.warning("Warning: Metric '{}' is not found. "
+                                            "Model performance monitoring is disabled.".format(self.mnt_metric))
+                        self.mnt_mode = 'off'
+                        improved = False
+
+                    if dist.is_initialized():
+                        # every rank follows rank 0, so no rank stops early and leaves the others in a collective
+                        improved_flag = torch.tensor([improved], dtype=torch.uint8, device=self.device)
+                        dist.broadcast(improved_flag, src=0)
+                        improved = bool(improved_flag.item())
+
+                    if improved:
+                        self.mnt_best = log[self.mnt_metric]
+                        not_improved_count = 0
+                        best = True
+                    else:
+                        not_improved_count += 1
+
+                    if not_improved_count > self.early_stop:
+                        self.logger.info("Validation performance didn\'t improve for {} epochs. "
+                                         "Training stops.".format(self.early_stop))
+                        break
+
+                if epoch % self.save_period == 0:
+                    self._save_checkpoint(epoch, save_best=best)
+        finally:
+            if self._profiler is not None:
+                self._profiler.stop()
+        self._finalize_checkpoint()
+        if self._log_code_thread is not None:
+            self._log_code_thread.join()
         if self.writer is not None:
             self.writer.finalize()
     
+    def _apply_activation_checkpointing(self, model, layer_names):
+        """
+        Recompute the activations of the configured blocks in backward, to be done before DDP forms its buckets
+
+        The recompute in backward runs with the running stats of BatchNorm layers frozen, so they are still updated
+        once per step.
+
+        :param model: model whose submodules are wrapped in place
+        :param layer_names: class names of the blocks to checkpoint
+        """
+        from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (CheckpointImpl,
+                                                                                 apply_activation_checkpointing,
+                                                                                 checkpoint_wrapper)
+
+        layer_names = set(layer_names)
+
+        def wrap(module):
+            # context_fn gives the contexts of the original forward and of the recompute
+            return checkpoint_wrapper(module, checkpoint_impl=CheckpointImpl.NO_REENTRANT,
+                                      context_fn=lambda: (nullcontext(), _frozen_batchnorm_stats(module)))
+
+        apply_activation_checkpointing(model, checkpoint_wrapper_fn=wrap,
+                                       check_fn=lambda m: type(m).__name__ in layer_names)
+
+    def _move_all(self, *modules):
+        """
+        Move modules into the configured device, convolution weights in channels_last format
+
+        :param modules: modules to move, None entries are skipped
+        """
+        for module in modules:
+            if module is not None:
+                module.to(self.device, memory_format=torch.channels_last, non_blocking=True)
+
     def _prepare_device(self, n_gpu_use):
         """
         setup GPU device if available, move model into configured device
         """
+        local_rank = init_distributed()
+        if local_rank is not None:
+            # launched with torchrun: each process drives the single GPU given by LOCAL_RANK
+            if not torch.cuda.is_available():
+                return torch.device('cpu'), []
+            return torch.device('cuda:{}'.format(local_rank)), [local_rank]
+
         n_gpu = torch.cuda.device_count()
         if n_gpu_use > 0 and n_gpu == 0:
             self.logger.warning("Warning: There\'s no GPU available on this machine,"
@@ -173,6 +404,9 @@ class BaseTrainer:
         :param log: logging information of the epoch
         :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
+        if not is_main_process():
+            return
+
         arch = type(self.model).__name__
 
         state = {
@@ -180,18 +414,99 @@ class BaseTrainer:
             'epoch': epoch,
             'state_dict': self.model.state_dict(),
             'optimizer': self.optimizer.state_dict(),
-            'monitor_best': self.mnt_best,
-            'masterVector': self.train_criterion.masterVector
-
+            'monitor_best': self.mnt_best
         }
         # filename = str(self.checkpoint_dir / 'checkpoint-epoch{}.pth'.format(epoch))
         # torch.save(state, filename)
         # self.logger.info("Saving checkpoint: {} ...".format(filename))
         if save_best:
             best_path = str(self.checkpoint_dir / 'model_best.pth')
-            torch.save(state, best_path)
+            # the staging buffers are reused, so the previous save has to be flushed first
+            self._finalize_checkpoint()
+            event = None
+            if self._copy_stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                self._copy_stream.wait_stream(current_stream)
+                with torch.cuda.stream(self._copy_stream):
+                    staged_state = self._stage(state)
+                    staged_state['masterVector'] = self._stage_master_vector()
+                event = self._copy_stream.record_event()
+                # kernels of the next step that update the weights in place are queued behind the copies,
+                # the host does not wait for them
+                current_stream.wait_stream(self._copy_stream)
+            else:
+                staged_state = self._stage(state)
+                staged_state['masterVector'] = self._stage_master_vector()
+            self._save_queue.put((epoch, staged_state, best_path, event))
             self.logger.info("Saving current best: model_best.pth at: {} ...".format(best_path))
 
+    def _stage(self, obj, key='state'):
+        """
+        Copy every tensor of a (nested) checkpoint into a cached pinned CPU buffer
+
+        :param obj: checkpoint entry, a tensor or a dict/list/tuple holding tensors
+        :param key: path of the entry inside the checkpoint, used to cache its buffer
+        """
+        if torch.is_tensor(obj):
+            buffer = self._staging_buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self._copy_stream is not None)
+                self._staging_buffers[key] = buffer
+            return buffer.copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            # shallow copy keeps the state_dict class and its _metadata
+            staged = copy.copy(obj)
+            for k, v in obj.items():
+                staged[k] = self._stage(v, '{}/{}'.format(key, k))
+            return staged
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._stage(v, '{}/{}'.format(key, i)) for i, v in enumerate(obj))
+        return obj
+
+    def _stage_master_vector(self):
+        """
+        Copy the class centroids of the train criterion into their pinned CPU buffer
+
+        The checkpoint keeps them in bfloat16 to halve the bytes moved, training still runs in float32.
+        """
+        master_vector = self.train_criterion.masterVector
+        if self._mv_pinned is None or self._mv_pinned.shape != master_vector.shape:
+            self._mv_pinned = torch.empty_like(master_vector, dtype=torch.bfloat16, device='cpu',
+                                               pin_memory=self._copy_stream is not None)
+        return self._mv_pinned.copy_(master_vector, non_blocking=True)
+
+    def _checkpoint_worker(self):
+        """
+        Background thread writing the staged checkpoints to disk
+        """
+        while True:
+            epoch, state, path, event = self._save_queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                # serialized in memory, so the many small zipfile records reach the disk as a few large chunks;
+                # the zipfile format keeps the checkpoint loadable with mmap
+                buffer = io.BytesIO()
+                torch.save(state, buffer)
+                with buffer.getbuffer() as payload:
+                    _write_file(path, payload)
+                self.logger.debug("Checkpoint of epoch {} written to: {}".format(epoch, path))
+            except Exception as e:
+                # keep serving the queue, the error is raised again on the training thread
+                self.logger.error("Saving checkpoint of epoch {} to {} failed: {}".format(epoch, path, e))
+                self._save_error = e
+            finally:
+                self._save_queue.task_done()
+
+    def _finalize_checkpoint(self):
+        """
+        Block until every queued checkpoint has been written to disk, re-raise the error of a failed save
+        """
+        self._save_queue.join()
+        if self._save_error is not None:
+            error, self._save_error = self._save_error, None
+            raise error
+
 
     def _resume_checkpoint(self, resume_path):
         """
@@ -201,10 +516,21 @@ class BaseTrainer:
         """
         resume_path = str(resume_path)
         self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
+        if dist.is_initialized():
+            # only rank 0 reads the file, the other ranks receive it through the process group
+            objects = [self._load_checkpoint(resume_path) if dist.get_rank() == 0 else None]
+            dist.broadcast_object_list(objects, src=0)
+            checkpoint = objects[0]
+        else:
+            checkpoint = self._load_checkpoint(resume_path)
         self.start_epoch = checkpoint['epoch'] + 1
         self.mnt_best = checkpoint['monitor_best']
-        self.train_criterion.masterVector = checkpoint['masterVector']
+        master_vector = checkpoint['masterVector']
+        if self.train_criterion.masterVector.shape == master_vector.shape:
+            # load into the existing device tensor (casting back to its float32), no new allocation
+            self.train_criterion.masterVector.copy_(master_vector)
+        else:
+            self.train_criterion.masterVector = master_vector.to(self.device, dtype=torch.float32)
         self.train_criterion.masterflag = False
         # load architecture params from checkpoint.
         if checkpoint['arch'] != self.config['arch']:
@@ -216,4 +542,14 @@ class BaseTrainer:
 
         self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
 
+    @staticmethod
+    def _load_checkpoint(resume_path):
+        """
+        Load a checkpoint on the CPU
+
+        :param resume_path: Checkpoint path to be loaded
+        """
+        # tensors are only mapped lazily; mmap needs the zipfile format, which older legacy checkpoints lack
+        return torch.load(resume_path, map_location='cpu', mmap=zipfile.is_zipfile(resume_path), weights_only=True)
+
 
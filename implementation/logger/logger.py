@@ -5,17 +5,21 @@ from pathlib import Path
 from utils import read_json
 
 
-def setup_logging(save_dir, log_config='logger/logger_config.json', default_level=logging.INFO):
+def setup_logging(save_dir, log_config='logger/logger_config.json', default_level=logging.INFO, file_handlers=True):
     """
-    Setup logging configuration
+    Setup logging configuration, without the handlers writing to files when file_handlers is False
     """
     log_config = Path(log_config)
     if log_config.is_file():
         config = read_json(log_config)
         # modify logging paths based on run config
-        for _, handler in config['handlers'].items():
+        for name, handler in list(config['handlers'].items()):
             if 'filename' in handler:
-                handler['filename'] = str(save_dir / handler['filename'])
+                if file_handlers:
+                    handler['filename'] = str(save_dir / handler['filename'])
+                else:
+                    del config['handlers'][name]
+                    config['root']['handlers'].remove(name)
 
         logging.config.dictConfig(config)
     else:
@@ -4,6 +4,7 @@ import random
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from parse_config import ConfigParser
@@ -79,7 +80,10 @@ class ncodLoss(nn.Module):
             self.masterVector_transpose = torch.transpose(masterVector_normalized, 0, 1)
             self.masterflag = True
 
-        self.prevSimilarity[index] = out1.detach()
+        # under DDP every rank records the features of the whole global batch, so the class centroids
+        # built from prevSimilarity and u are the same on every rank
+        all_index = self._all_gather(index.to(out1.device))
+        self.prevSimilarity[all_index] = self._all_gather(out1.detach())
 
         prediction = F.softmax(output, dim=1)
 
@@ -90,7 +94,7 @@ class ncodLoss(nn.Module):
         similarity = similarity * label
         sim_mask = (similarity > 0.000).type(torch.float32)
         similarity = similarity * sim_mask
-        self.impVecSim[index] = torch.sum(similarity, dim=1).view(-1, 1)
+        self.impVecSim[all_index] = self._all_gather(torch.sum(similarity, dim=1).view(-1, 1))
         u = u * label
 
         prediction = torch.clamp((prediction + u.detach()), min=eps, max=1.0)
@@ -100,7 +104,7 @@ class ncodLoss(nn.Module):
 
         MSE_loss = F.mse_loss((label_one_hot + u), label, reduction='sum') / len(label)
         loss += MSE_loss
-        self.take[index] = torch.sum((label_one_hot * label), dim=1).view(-1, 1)
+        self.take[all_index] = self._all_gather(torch.sum((label_one_hot * label), dim=1).view(-1, 1))
 
 
         if self.ratio_balance > 0:
@@ -125,6 +129,30 @@ class ncodLoss(nn.Module):
 
 
 
+    @staticmethod
+    def _all_gather(tensor):
+        """
+        Concatenate the tensor of every rank, the tensor itself when not running distributed
+        """
+        if not dist.is_initialized():
+            return tensor
+        gathered = tensor.new_empty((dist.get_world_size() * tensor.shape[0],) + tuple(tensor.shape[1:]))
+        dist.all_gather_into_tensor(gathered, tensor.contiguous())
+        return gathered
+
+    def all_reduce_grads(self):
+        """
+        Sum the gradients of the per-sample parameters u and v over the ranks
+
+        Each rank only produces gradients for the rows of its own shard, so the sum gives every rank the full
+        gradient. Call it between backward and the step of the optimizer of u and v.
+        """
+        if not dist.is_initialized():
+            return
+        for param in (self.u, self.v):
+            if param.grad is not None:
+                dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+
     def consistency_loss(self, index, output1, output2):            
         preds1 = F.softmax(output1, dim=1).detach()
         preds2 = F.log_softmax(output2, dim=1)
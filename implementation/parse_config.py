@@ -6,7 +6,7 @@ from operator import getitem
 from pathlib import Path
 
 from logger import setup_logging
-from utils import read_json, write_json
+from utils import is_main_process, read_json, write_json
 
 
 class ConfigParser:
@@ -68,14 +68,16 @@ class ConfigParser:
         self._save_dir = save_dir / 'models' / exper_name / timestamp
         self._log_dir = save_dir / 'log' / exper_name / timestamp
 
-        self.save_dir.mkdir(parents=True, exist_ok=True)
-        self.log_dir.mkdir(parents=True, exist_ok=True)
+        # under torchrun only rank 0 creates the run directories and writes the config and log files
+        if is_main_process():
+            self.save_dir.mkdir(parents=True, exist_ok=True)
+            self.log_dir.mkdir(parents=True, exist_ok=True)
 
-        # save updated config file to the checkpoint dir
-        write_json(self.config, self.save_dir / 'config.json')
+            # save updated config file to the checkpoint dir
+            write_json(self.config, self.save_dir / 'config.json')
 
         # configure logging module
-        setup_logging(self.log_dir)
+        setup_logging(self.log_dir, file_handlers=is_main_process())
         self.log_levels = {
             0: logging.WARNING,
             1: logging.INFO,
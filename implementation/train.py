@@ -13,6 +13,7 @@ import model.metric as module_metric
 import model.model as module_arch
 from parse_config import ConfigParser
 from trainer import Trainer
+from utils import init_distributed, is_main_process
 
 
 def log_params(conf: OrderedDict, parent_key: str = None):
@@ -32,6 +33,9 @@ def main(config: ConfigParser):
 
     logger = config.get_logger('train')
 
+    # set up the process group before the data loaders so they can shard the training set
+    init_distributed()
+
     data_loader = getattr(module_data, config['data_loader']['type'])(
         config['data_loader']['args']['data_dir'],
         batch_size= config['data_loader']['args']['batch_size'],
@@ -63,7 +67,8 @@ def main(config: ConfigParser):
     reparametrization_net = None#config.initialize('reparam_arch', module_arch)  
 
     # get function handles of loss and metrics
-    logger.info(config.config)
+    if is_main_process():
+        logger.info(config.config)
     if hasattr(data_loader.dataset, 'num_raw_example'):
         num_examp = data_loader.dataset.num_raw_example
     else:
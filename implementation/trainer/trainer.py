@@ -5,7 +5,7 @@ import torch
 from base import BaseTrainer
 from model.denserCluster import distribution
 from tqdm import tqdm
-from utils import inf_loop
+from utils import inf_loop, is_main_process
 
 
 class Trainer(BaseTrainer):
@@ -82,7 +82,7 @@ class Trainer(BaseTrainer):
         indices = self.data_loader.train_dataset.indexs
         pureIndexs = list(set(indices) - set(noiseindex))
 
-        with tqdm(self.data_loader) as progress:
+        with tqdm(self.data_loader, disable=not is_main_process()) as progress:
             for batch_idx, (data, data2, label, indexs, _) in enumerate(progress):
                 progress.set_description_str(f'Train epoch {epoch}')
 
@@ -110,6 +110,7 @@ class Trainer(BaseTrainer):
 
 
                 loss.backward()
+                self.train_criterion.all_reduce_grads()
 
                 self.optimizer_loss.step()
                 self.optimizer.step()
@@ -158,6 +159,9 @@ class Trainer(BaseTrainer):
                         self._progress(batch_idx),
                         loss.item()))
 
+                if self._profiler is not None:
+                    self._profiler.step()
+
                 if batch_idx == self.len_epoch:
                     break
 
@@ -246,7 +250,7 @@ class Trainer(BaseTrainer):
         total_val_loss = 0
         total_val_metrics = np.zeros(len(self.metrics))
         with torch.no_grad():
-            with tqdm(self.valid_data_loader) as progress:
+            with tqdm(self.valid_data_loader, disable=not is_main_process()) as progress:
                 for batch_idx, (data, label, indexs, _) in enumerate(progress):
                     progress.set_description_str(f'Valid epoch {epoch}')
                     data, label = data.to(self.device), label.to(self.device)
@@ -294,7 +298,7 @@ class Trainer(BaseTrainer):
         results = np.zeros((len(self.test_data_loader.dataset), self.config['num_classes']), dtype=np.float32)
         tar_ = np.zeros((len(self.test_data_loader.dataset),), dtype=np.float32)
         with torch.no_grad():
-            with tqdm(self.test_data_loader) as progress:
+            with tqdm(self.test_data_loader, disable=not is_main_process()) as progress:
                 for batch_idx, (data, label,indexs,_) in enumerate(progress):
                     progress.set_description_str(f'Test epoch {epoch}')
                     data, label = data.to(self.device), label.to(self.device)
@@ -340,7 +344,7 @@ class Trainer(BaseTrainer):
         data_loader = self.data_loader#self.loader.run('warmup')
 
 
-        with tqdm(data_loader) as progress:
+        with tqdm(data_loader, disable=not is_main_process()) as progress:
             for batch_idx, (data, _, label, indexs , _) in enumerate(progress):
                 progress.set_description_str(f'Warm up epoch {epoch}')
 
@@ -370,6 +374,9 @@ class Trainer(BaseTrainer):
                         loss.item()))
                     # self.writer.add_image('input', make_grid(data.cpu(), nrow=8, normalize=True))
 
+                if self._profiler is not None:
+                    self._profiler.step()
+
                 if batch_idx == self.len_epoch:
                     break
         if hasattr(self.data_loader, 'run'):
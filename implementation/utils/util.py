@@ -1,10 +1,13 @@
 import json
+import os
 from collections import OrderedDict
 from datetime import datetime
 from itertools import repeat
 from pathlib import Path
 
 import numpy as np
+import torch
+import torch.distributed as dist
 
 
 def ensure_dir(dirname):
@@ -23,6 +26,27 @@ def write_json(content, fname):
         json.dump(content, handle, indent=4, sort_keys=False)
 
 
+def init_distributed():
+    ''' initialize the default process group when launched with torchrun, returns the local rank or None. '''
+    if not dist.is_initialized() and int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return None
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            dist.init_process_group(backend='nccl')
+        else:
+            dist.init_process_group(backend='gloo')
+    return local_rank
+
+
+def is_main_process():
+    ''' True when not running distributed, or on rank 0 (read from the torchrun env before the process group exists). '''
+    if dist.is_initialized():
+        return dist.get_rank() == 0
+    return int(os.environ.get('RANK', 0)) == 0
+
+
 def inf_loop(data_loader):
     ''' wrapper function for endless data loader. '''
     for loader in repeat(data_loader):